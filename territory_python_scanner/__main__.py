@@ -1,19 +1,32 @@
+import os
 from argparse import ArgumentParser
 from pathlib import Path
 
+# Serializing nodes is much faster with the C runtime, it has to be picked
+# before protobuf is first imported.
+os.environ.setdefault('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION', 'upb')
+
+from google.protobuf.internal import api_implementation
+
 from .scanner import scan_repo
 
+if api_implementation.Type() not in ('upb', 'cpp'):
+    print(f'warning: using the {api_implementation.Type()} protobuf implementation, scanning will be slow')
+
 arg_parser = ArgumentParser()
 arg_parser.add_argument('repo_root', type=Path)
 arg_parser.add_argument('uim_dir', type=Path)
 arg_parser.add_argument('--system', action='store_true')
 arg_parser.add_argument('-v', action='store_true')
+arg_parser.add_argument('-j', '--jobs', type=int, help='number of worker processes, defaults to CPU count')
+arg_parser.add_argument('--no-cache', action='store_true', help="rescan all files, don't use or update the scan cache")
 args = arg_parser.parse_args()
 
 repo_root: Path = args.repo_root
 args.uim_dir.mkdir(exist_ok=True, parents=True)
 nodes_uim_path = str(args.uim_dir / 'nodes.uim')
 search_uim_path = str(args.uim_dir / 'search.uim')
+cache_path = None if args.no_cache else str(args.uim_dir / 'scan.cache')
 
 print(f'writing output to {args.uim_dir}')
 scan_repo(
@@ -21,4 +34,6 @@ scan_repo(
     nodes_uim_path,
     search_uim_path,
     system=args.system,
-    verbose=args.v)
+    verbose=args.v,
+    jobs=args.jobs,
+    cache_path=cache_path)
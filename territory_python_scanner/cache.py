@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Optional
+
+import jedi
+
+from . import __version__
+
+
+# Output depends on the scanner and on how jedi resolves names.  The leading
+# number is the layout of the files table.
+CACHE_VERSION = f'2 {__version__} jedi {jedi.__version__}'
+
+
+def stat_key(path: str) -> tuple[int, int]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (-1, -1)
+    return (st.st_mtime_ns, st.st_size)
+
+
+class ScanCache:
+    """
+    Scan results of unchanged files, kept between runs.
+
+    An entry is the encoded node and search records of one file along with the
+    paths its references point to.  It's valid as long as the file and every
+    module jedi loaded while scanning it have the same mtime and size as when
+    it was stored.  Adding or removing a file can change where imports resolve
+    without touching any of those, so the whole cache is dropped when the set
+    of repo files changes.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        # stat results of this run, most entries depend on the same modules
+        self.stats = {}
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != CACHE_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS files')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (CACHE_VERSION,))
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER,
+                size INTEGER,
+                deps TEXT,
+                referenced TEXT,
+                nodes BLOB,
+                search BLOB
+            )''')
+        self.db.commit()
+
+    def stat(self, path: str) -> tuple[int, int]:
+        if path not in self.stats:
+            self.stats[path] = stat_key(path)
+        return self.stats[path]
+
+    def check_paths(self, paths: list[str]) -> None:
+        """Drop all entries if the repo files are not the same as last time."""
+        digest = hashlib.sha1('\0'.join(sorted(paths)).encode()).hexdigest()
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'paths'").fetchone()
+        if row is None or row[0] != digest:
+            self.db.execute('DELETE FROM files')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('paths', ?)", (digest,))
+
+    def get(self, path: str, key: tuple[int, int]) -> Optional[tuple[bytes, bytes, set]]:
+        """
+        Return the stored (nodes, search, referenced paths) of a file or None if
+        there is no valid entry.
+        """
+        row = self.db.execute(
+            'SELECT mtime_ns, size, deps, referenced, nodes, search FROM files WHERE path = ?',
+            (path,)).fetchone()
+        if row is None or (row[0], row[1]) != key:
+            return None
+        deps = json.loads(row[2])
+        for dep, dep_key in deps.items():
+            if self.stat(dep) != tuple(dep_key):
+                return None
+        return row[4], row[5], set(json.loads(row[3]))
+
+    def put(self, path: str, key: tuple[int, int], result: tuple[bytes, bytes, set], loaded: set) -> None:
+        """
+        Store the result of scanning a file that had the given stat key before
+        the scan.  loaded are the paths of all modules jedi went through.
+        """
+        nodes, search, referenced = result
+        deps = {dep: self.stat(dep) for dep in referenced | loaded}
+        self.db.execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path, key[0], key[1], json.dumps(deps), json.dumps(sorted(referenced)), nodes, search))
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
@@ -1,10 +1,15 @@
-from contextlib import closing
-from dataclasses import dataclass, replace
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import closing, nullcontext
+from dataclasses import dataclass, field
 from pathlib import Path
 from traceback import print_exc
 
+import numpy as np
+
 from jedi import Script, get_default_project
 from jedi.api.classes import Name
+from jedi.parser_utils import get_parent_scope
 from parso.tree import NodeOrLeaf, Leaf, BaseNode
 from parso.python.tree import (
     PythonNode,
@@ -17,6 +22,7 @@ from parso.python.tree import (
     Name as TName,
 )
 
+from .cache import ScanCache, stat_key
 from .writer import UimNodeWriter, UimTokenWriter, UimSearchIndexWriter
 from .uim_pb2 import Location
 from .timeout import setup_timeout, clear_timeout
@@ -24,6 +30,7 @@ from .timeout import setup_timeout, clear_timeout
 
 _path_expansions = {}
 _line_offsets = {}
+_projects = {}
 
 
 def write_ws_and_comments(uim_node: UimTokenWriter, prefix: str, href: dict, real_line: int, elided: bool):
@@ -31,31 +38,88 @@ def write_ws_and_comments(uim_node: UimTokenWriter, prefix: str, href: dict, rea
     uim_node.append_token('WS', prefix, href, real_line=real_line, elided=elided)
 
 
-def expand_path(p: Path):
-    if p not in _path_expansions:
-        _path_expansions[p] = p.resolve()
-    return _path_expansions[p]
+def expand_path(p: str | Path) -> str:
+    # called for every resolved reference, keep the hit path to one lookup
+    s = os.fspath(p)
+    r = _path_expansions.get(s)
+    if r is None:
+        r = _path_expansions[s] = os.path.realpath(s)
+    return r
 
 
-def scan_line_offsets(code):
-    offs = [0]
-    o = 0
-    for l in code.splitlines(keepends=True):
-        o += len(l)
-        offs.append(o)
+def list_dir(d: str) -> tuple[list[str], list[str]]:
+    """Return the subdirectories to descend into and the .py files of d."""
+    subdirs = []
+    paths = []
+    try:
+        with os.scandir(d) as it:
+            entries = list(it)
+    except OSError:
+        # unreadable directories are skipped, like Path.glob does
+        return subdirs, paths
+    # DirEntry caches the file type from readdir, so this doesn't stat every entry
+    for e in entries:
+        if e.is_dir(follow_symlinks=False):
+            if e.name != 'site-packages':
+                subdirs.append(e.path)
+        elif e.name.endswith('.py'):
+            paths.append(e.path)
+    return subdirs, paths
+
+
+def walk_py(root: str | Path):
+    stack = [os.fspath(root)]
+    while stack:
+        subdirs, paths = list_dir(stack.pop())
+        stack.extend(subdirs)
+        yield from paths
+
+
+def gather_py_paths(root: str | Path, max_workers: int = 8) -> list[str]:
+    # Top-level directories are walked in parallel, directory reads release
+    # the GIL and this matters on slow (e.g. network) filesystems.
+    subdirs, paths = list_dir(os.fspath(root))
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        for chunk in ex.map(lambda d: list(walk_py(d)), subdirs):
+            paths.extend(chunk)
+    return paths
+
+
+def scan_line_offsets(code: str | bytes) -> np.ndarray:
+    if isinstance(code, str):
+        code = code.encode('utf-8')
+    buf = np.frombuffer(code, dtype=np.uint8)
+    # This is already a vectorised scan.  A numba loop was slower on large
+    # sources and only saves microseconds on small ones.
+    # Lines end at \n, \r\n or a lone \r, like parso splits them.
+    breaks = buf == 0x0A
+    cr = buf == 0x0D
+    cr[:-1] &= ~breaks[1:]
+    breaks |= cr
+    nl = np.flatnonzero(breaks)
+    offs = np.empty(len(nl) + 2, dtype=np.int64)
+    offs[0] = 0
+    offs[1:-1] = nl + 1
+    offs[-1] = len(buf)
     return offs
 
 
 def get_offset(path: str, line, col):
     try:
         if path not in _line_offsets:
-            with open(path, 'rb') as f:
-                _line_offsets[path] = scan_line_offsets(f.read())
-        return _line_offsets[path][line-1] + col
+            _line_offsets[path] = scan_line_offsets(Path(path).read_bytes())
+        return int(_line_offsets[path][line-1]) + col
     except Exception as e:
         raise KeyError(f'failed to resolve offset for {path}:{line}:{col}') from e
 
 
+def module_code_lines(name: Name) -> list[str] | None:
+    try:
+        return name._name.get_root_context().code_lines
+    except Exception:
+        return None
+
+
 def loc_of(path: str, tree: NodeOrLeaf) -> Location:
     line, col = tree.start_pos
     return Location(
@@ -73,15 +137,33 @@ def uni_href(path: str, tree: NodeOrLeaf) -> dict:
     }
 
 
+def _with_subclasses(cls):
+    yield cls
+    for sub in cls.__subclasses__():
+        yield from _with_subclasses(sub)
+
+
+# exact leaf type -> token type, parso leaves are never subclassed outside of parso
+_TOK_TYPES = {
+    sub: tt
+    for cls, tt in [(Keyword, 'Keyword'), (Literal, 'Literal'), (Operator, 'Punctuation')]
+    for sub in _with_subclasses(cls)
+}
+_SKIPPED_TYPES = frozenset(_with_subclasses(EndMarker))
+
+
+def prefix_start_line(tree: Leaf, prefix: str) -> int:
+    # Same as tree.get_start_pos_of_prefix()[0]: the prefix ends where the leaf
+    # starts, so count its line breaks (\n, \r\n and \r, as parso splits lines)
+    # instead of searching back for the previous leaf.
+    breaks = prefix.count('\n')
+    if '\r' in prefix:
+        breaks += prefix.count('\r') - prefix.count('\r\n')
+    return tree.line - breaks
+
+
 def tok_type(tree: Leaf) -> str:
-    if isinstance(tree, Keyword):
-        return 'Keyword'
-    elif isinstance(tree, Literal):
-        return 'Literal'
-    elif isinstance(tree, Operator):
-        return 'Punctuation'
-    else:
-        return 'Identifier'
+    return _TOK_TYPES.get(type(tree), 'Identifier')
 
 
 class ScanQueue:
@@ -90,17 +172,15 @@ class ScanQueue:
         self.pending = set()
         self.processed = set()
 
-    def add_dir(self, dir: Path):
-        for f in dir.glob('**/*.py'):
-            if 'site-packages' in f.parts:
-                continue
+    def add_dir(self, dir: str | Path):
+        for f in gather_py_paths(dir):
             self.add_path(f)
 
-    def add_imported(self, p: Path):
+    def add_imported(self, p: str | Path):
         if self.system:
             self.add_path(p)
 
-    def add_path(self, p: Path):
+    def add_path(self, p: str | Path):
         p = expand_path(p)
         if p not in self.processed:
             self.pending.add(p)
@@ -110,14 +190,14 @@ class ScanQueue:
         self.mark_processed(p)
         return p
 
-    def mark_processed(self, p: Path):
+    def mark_processed(self, p: str):
         self.processed.add(p)
 
     def __bool__(self):
         return len(self.pending) > 0
 
 
-@dataclass(frozen=True)
+@dataclass(slots=True)
 class G:
     path: str
     script: Script
@@ -125,157 +205,318 @@ class G:
     search_writer: UimSearchIndexWriter
     uim_node: UimTokenWriter
     depth: int
-    omit_initial_prefix: bool
     href: dict | None
     member_of: str | None
-    scan_queue: ScanQueue
+    # paths of the modules references point to
+    referenced: set
     elided: bool
     reference_context: str | None
     verbose: bool
+    # id(scope) -> names bound in that scope, None disables shared goto results
+    bindings: dict | None = None
+    # (name, id(scope)) -> resolved href, one per file
+    href_cache: dict = field(default_factory=dict)
+
+
+def scope_bindings(module: Module) -> dict | None:
+    # star imports bind names we can't see, don't share anything in such files
+    if any(imp.is_star_import() for imp in module.iter_imports()):
+        return None
+
+    bindings = {}
+    for names in module.get_used_names().values():
+        for n in names:
+            # jedi treats `x[i] = ...` as a definition of x too
+            if not n.is_definition(include_setitem=True):
+                continue
+            scope = get_parent_scope(n)
+            bindings.setdefault(id(scope), set()).add(n.value)
+            # the element expression of a comprehension sits outside of the
+            # comp_for scope, treat its names as bound in the enclosing scopes too
+            while scope.type in ('comp_for', 'sync_comp_for'):
+                scope = get_parent_scope(scope)
+                bindings.setdefault(id(scope), set()).add(n.value)
+    return bindings
+
+
+def shared_goto_key(g: G, tree: TName) -> tuple | None:
+    # A name that is not bound in its own scope resolves the same way
+    # everywhere in that scope.  Attributes, keyword arguments and import
+    # paths depend on what's around them, so they are resolved individually.
+    if g.bindings is None or tree.is_definition(include_setitem=True):
+        return None
+    if tree.search_ancestor('import_from', 'import_name'):
+        return None
+    prev = tree.get_previous_leaf()
+    if prev is not None and prev.value == '.':
+        return None
+    if tree.parent.type == 'argument':
+        nxt = tree.get_next_leaf()
+        if nxt is not None and nxt.value == '=':
+            return None
+
+    scope = get_parent_scope(tree)
+    if tree.value in g.bindings.get(id(scope), ()):
+        return None
+    return (tree.value, id(scope))
+
+
+def resolve_href(g: G, tree: TName) -> dict | None:
+    try:
+        locs = g.script.goto(
+            tree.line,
+            tree.column,
+            follow_imports=True,
+            follow_builtin_imports=True)
+    except TimeoutError:
+        raise
+    except:
+        print_exc()
+        return None
+    if not locs:
+        return None
+
+    name: Name = locs[0]
+    if name.line is None or name.column is None or name.module_path is None:
+        if g.verbose and name.module_name != 'builtins':
+            print('no location for', name)
+        return None
+
+    p = expand_path(name.module_path)
+    g.referenced.add(p)
+    if p not in _line_offsets:
+        # jedi has already loaded the module, don't read it from disk again
+        if (lines := module_code_lines(name)) is not None:
+            _line_offsets[p] = scan_line_offsets(''.join(lines))
+    try:
+        return {
+            'path': p,
+            'offset': get_offset(p, name.line, name.column)
+        }
+    except KeyError as ke:
+        print(f'{g.path}:{tree.line}:{tree.column} {name.full_name}: {ke}')
+        return None
+
+
+def is_definition(tree: NodeOrLeaf) -> bool:
+    return isinstance(tree, ClassOrFunc) or (isinstance(tree, PythonNode) and tree.type == 'decorated')
+
+
+def begin_definition(g: G, stack: list, tree: NodeOrLeaf, omit_initial_prefix: bool):
+    is_decorated = not isinstance(tree, ClassOrFunc)
+    point_to = tree
+    while (isinstance(point_to, PythonNode) and point_to.type == 'decorated'):
+        point_to = point_to.children[-1]
+    if getattr(point_to, 'name', None):
+        point_to = point_to.name
+
+    name = getattr(point_to, 'value', None)
+    reference_context = g.reference_context
+    if name:
+        if reference_context:
+            reference_context += '.' +  name
+        else:
+            reference_context = name
+
+    start = loc_of(g.path, tree)
+    node = g.node_writer.begin_node(
+        'Definition',
+        g.path,
+        start=start,
+        nest_level=g.depth+1,
+        member_of=g.member_of,
+        reference_context=reference_context)
+
+    # Run in reverse: the full definition goes to its own node, then the
+    # elided summary to the enclosing node, then the symbol to the index.
+    # point_to and the start offset are only worked out here and carried along.
+    stack.append(('end_elided', point_to, (g.href, start.offset)))
+    stack.append(('elided_decorated' if is_decorated else 'elided_def', tree, omit_initial_prefix))
+    saved = g.uim_node, g.depth, g.member_of, g.reference_context
+    stack.append(('end_def', node, (saved, uni_href(g.path, point_to))))
+    stack.append(('decorated' if is_decorated else 'content', tree, True))
+
+    g.uim_node = node
+    g.depth += 1
+    g.member_of = name
+    g.reference_context = reference_context
+
+
+def write_leaf(g: G, tree: Leaf):
+    href = g.href
+    # Only names can be resolved by jedi, don't waste a goto on keywords,
+    # literals and punctuation.  Elided signatures always link to their
+    # definition (g.href is set) and never need a goto either.
+    if not href and not g.elided and isinstance(tree, TName):
+        key = shared_goto_key(g, tree)
+        if key is None:
+            href = resolve_href(g, tree)
+        elif key in g.href_cache:
+            href = g.href_cache[key]
+        else:
+            href = g.href_cache[key] = resolve_href(g, tree)
+    g.uim_node.append_token(
+        tok_type(tree),
+        tree.value,
+        href,
+        real_line=tree.line,
+        location=loc_of(g.path, tree),
+        elided=g.elided,
+    )
+
+
+def push_children(stack: list, op: str, children: list, omit_initial_prefix: bool):
+    # reversed, so that they are popped in source order
+    for c in reversed(children[1:]):
+        stack.append((op, c, False))
+    if children:
+        stack.append((op, children[0], omit_initial_prefix))
 
 
-def write_tree(g: G, tree: NodeOrLeaf):
-    is_decorated = (isinstance(tree, PythonNode) and tree.type == 'decorated')
-    if isinstance(tree, ClassOrFunc) or is_decorated:
-        point_to = tree
-        while (isinstance(point_to, PythonNode) and point_to.type == 'decorated'):
-            point_to = point_to.children[-1]
-        if getattr(point_to, 'name', None):
-            point_to = point_to.name
-
-        name = getattr(point_to, 'value', None)
-        reference_context = g.reference_context
-        if name:
-            if reference_context:
-                reference_context += '.' +  name
+def walk(g: G, roots: list[NodeOrLeaf]):
+    # Entries are (op, tree, arg).  'tree' and 'content' take the
+    # omit_initial_prefix flag as arg, 'tree' starts a definition node when
+    # it finds one, otherwise it's the same as 'content'.
+    stack = []
+    push_children(stack, 'tree', roots, False)
+    while stack:
+        op, tree, arg = stack.pop()
+
+        if op == 'tree':
+            if is_definition(tree):
+                begin_definition(g, stack, tree, arg)
+                continue
+            op = 'content'
+
+        if op == 'content':
+            # only leaves have a prefix, most of them an empty one
+            if isinstance(tree, Leaf):
+                if type(tree) in _SKIPPED_TYPES:
+                    continue
+                if (pf := tree.prefix) and not arg:
+                    pline = prefix_start_line(tree, pf)
+                    write_ws_and_comments(g.uim_node, pf, g.href, pline, g.elided)
+                write_leaf(g, tree)
+            elif isinstance(tree, BaseNode):
+                push_children(stack, 'tree', tree.children, arg)
             else:
-                reference_context = name
-
-        node = g.node_writer.begin_node(
-            'Definition',
-            g.path,
-            start=loc_of(g.path, tree),
-            nest_level=g.depth+1,
-            member_of=g.member_of,
-            reference_context=reference_context)
-        if is_decorated:
-            w = write_decorated
-        else:
-            w = write_content
-        w(
-            replace(
-                g,
-                uim_node=node,
-                depth=g.depth+1,
-                omit_initial_prefix=True,
-                member_of=name,
-                reference_context=reference_context,
-            ),
-            tree)
-        g.node_writer.write_node(node)
-
-        if is_decorated:
-            we = write_elided_decorated_def
+                raise ValueError(f'expected either a Leaf or a BaseNode, got {tree}')
+
+        elif op == 'decorated':
+            push_children(stack, 'content', tree.children, arg)
+
+        elif op == 'end_def':
+            saved, g.href = arg
+            g.uim_node, g.depth, g.member_of, g.reference_context = saved
+            g.node_writer.write_node(tree)
+
+        elif op == 'elided_def':
+            # the signature, up to and including the colon
+            children = tree.children
+            has_colon = False
+            for i, c in enumerate(children):
+                if isinstance(c, Operator) and c.value == ':':
+                    children = children[:i+1]
+                    has_colon = True
+                    break
+            stack.append(('end_elided_def', tree, (g.elided, has_colon)))
+            for c in reversed(children):
+                stack.append(('content', c, arg))
+            g.elided = True
+
+        elif op == 'end_elided_def':
+            g.elided, has_colon = arg
+            if has_colon:
+                g.uim_node.append_token('WS', ' …', g.href, elided=True)
+
+        elif op == 'elided_decorated':
+            entries = []
+            for c in tree.children:
+                if isinstance(c, ClassOrFunc):
+                    entries.append(('elided_def', c, arg))
+                    break
+                entries.append(('content', c, arg))
+            stack.extend(reversed(entries))
+
+        elif op == 'end_elided':
+            g.href, start_offset = arg
+            if isinstance(tree, TName):
+                g.search_writer.append(
+                    'IISymbol',
+                    tree.value,
+                    {'path': g.path, 'offset': start_offset},
+                    g.path,
+                    None)
+
         else:
-            we = write_elided_def
-        we(replace(g, href=uni_href(g.path, point_to)), tree)
-
-        if isinstance(point_to, TName):
-            line, col = tree.start_pos
-            g.search_writer.append(
-                'IISymbol',
-                point_to.value,
-                {'path': g.path, 'offset': get_offset(g.path, line, col)},
-                g.path,
-                None)
-    else:
-        write_content(g, tree)
-
-
-def write_decorated(g: G, tree: NodeOrLeaf):
-    for c in tree.children:
-        write_content(g, c)
-        if g.omit_initial_prefix:
-            g = replace(g, omit_initial_prefix=False)
-
-
-def write_content(g: G, tree: NodeOrLeaf):
-    if isinstance(tree, EndMarker):
-        return
-
-    if pf := getattr(tree, 'prefix', None):
-        if not g.omit_initial_prefix:
-            pline, _ = tree.get_start_pos_of_prefix()
-            write_ws_and_comments(g.uim_node, pf, g.href, pline, g.elided)
-        g = replace(g, omit_initial_prefix=False)
-    if isinstance(tree, Leaf):
-        href = g.href
-        if not href:
-            locs = None
-            if tree.value not in ['(', ')', ',', '=', '.', ':', '}', '\n']:
-                try:
-                    locs = g.script.goto(
-                        tree.line,
-                        tree.column,
-                        follow_imports=True,
-                        follow_builtin_imports=True)
-                except TimeoutError:
-                    raise
-                except:
-                    print_exc()
-            if locs:
-                name: Name = locs[0]
-                if name.line is None or name.column is None or name.module_path is None:
-                    if g.verbose and name.module_name != 'builtins':
-                        print('no location for', name)
-                else:
-                    p = expand_path(name.module_path)
-                    g.scan_queue.add_imported(p)
-                    try:
-                        href = {
-                            'path': str(p),
-                            'offset': get_offset(p, name.line, name.column)
-                        }
-                    except KeyError as ke:
-                        print(f'{g.path}:{tree.line}:{tree.column} {name.full_name}: {ke}')
-        g.uim_node.append_token(
-            tok_type(tree),
-            tree.value,
-            href,
-            real_line=tree.line,
-            location=loc_of(g.path, tree),
-            elided=g.elided,
-        )
-    elif isinstance(tree, BaseNode):
-        for c in tree.children:
-            write_tree(g, c)
-            if g.omit_initial_prefix:
-                g = replace(g, omit_initial_prefix=False)
-    else:
-        raise ValueError(f'expected either a Leaf or a BaseNode, got {tree}')
-
-
-def write_elided_def(g: G, df: ClassOrFunc):
-    g = replace(g, elided=True)
-    for c in df.children:
-        write_content(g, c)
-        if isinstance(c, Operator) and c.value == ':':
-            g.uim_node.append_token('WS', ' …', g.href, elided=True)
-            break
-
-
-def write_elided_decorated_def(g: G, df: PythonNode):
-    for c in df.children:
-        if isinstance(c, ClassOrFunc):
-            write_elided_def(g, c)
-            break
-        write_content(g, c)
-
-
-def scan_repo(repo_root, nodes_uim_path, search_uim_path, system=False, verbose=False):
+            raise ValueError(f'unknown walk op: {op}')
+
+
+def loaded_module_paths(script: Script) -> set:
+    # References depend on every module imports went through on the way to
+    # the definition, not only on the one they end up in.
+    paths = set()
+    for values in script._inference_state.module_cache._name_cache.values():
+        for value in values:
+            if (f := value.py__file__()) is not None:
+                paths.add(expand_path(f))
+    return paths
+
+
+def scan_file(path: str, repo_root: Path, verbose: bool) -> tuple[bytes, bytes, set, set, bool]:
+    if repo_root not in _projects:
+        _projects[repo_root] = get_default_project(repo_root)
+    project = _projects[repo_root]
+
+    uim_node_writer = UimNodeWriter()
+    search_writer = UimSearchIndexWriter()
+
+    script = Script(path=Path(path), project=project)
+
+    module_node = script._module_node
+    assert isinstance(module_node, Module)
+
+    code = script._code
+    assert isinstance(code, str)
+    _line_offsets[path] = scan_line_offsets(code)
+
+    file_node = uim_node_writer.begin_node('SourceFile', path, nest_level=0)
+
+    g = G(
+        path=path,
+        script=script,
+        node_writer=uim_node_writer,
+        search_writer=search_writer,
+        uim_node=file_node,
+        depth=0,
+        href=None,
+        member_of=None,
+        referenced=set(),
+        elided=False,
+        reference_context=None,
+        verbose=verbose,
+        bindings=scope_bindings(module_node))
+
+    complete = False
+    setup_timeout(120)
+    try:
+        walk(g, module_node.children)
+        complete = True
+    except Exception:
+        print_exc()
+    finally:
+        clear_timeout()
+
+    uim_node_writer.write_node(file_node)
+    return (uim_node_writer.getvalue(), search_writer.getvalue(), g.referenced,
+            loaded_module_paths(script), complete)
+
+
+def scan_repo(repo_root, nodes_uim_path, search_uim_path, system=False, verbose=False, jobs=None, cache_path=None):
     if not repo_root.exists():
         raise IOError(f'directory does not exist: {repo_root}')
-    project = get_default_project(repo_root)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
 
     scan_queue = ScanQueue(system=system)
     scan_queue.add_dir(repo_root)
@@ -283,44 +524,62 @@ def scan_repo(repo_root, nodes_uim_path, search_uim_path, system=False, verbose=
     with (
         closing(UimNodeWriter(nodes_uim_path)) as uim_node_writer,
         closing(UimSearchIndexWriter(search_uim_path)) as search_writer,
+        closing(ScanCache(cache_path)) if cache_path else nullcontext() as cache,
     ):
-        while scan_queue:
+        if cache is not None:
+            cache.check_paths(list(scan_queue.pending))
+
+        def next_path():
             path = scan_queue.next()
             print(f'[{len(scan_queue.processed)}/{len(scan_queue.pending) + len(scan_queue.processed)}] {path}')
-            script = Script(path=path, project=project)
-            path = str(path)
-
-            module_node = script._module_node
-            assert isinstance(module_node, Module)
-
-            code = script._code
-            assert isinstance(code, str)
-            _line_offsets[path] = scan_line_offsets(code)
-
-            file_node = uim_node_writer.begin_node('SourceFile', path, nest_level=0)
-
-            g = G(
-                path=path,
-                script=script,
-                node_writer=uim_node_writer,
-                search_writer=search_writer,
-                uim_node=file_node,
-                depth=0,
-                omit_initial_prefix=False,
-                href=None,
-                member_of=None,
-                scan_queue=scan_queue,
-                elided=False,
-                reference_context=None,
-                verbose=verbose)
-
-            setup_timeout(120)
-            try:
-                for df in module_node.children:
-                    write_tree(g, df)
-            except Exception:
-                print_exc()
-            finally:
-                clear_timeout()
-
-            uim_node_writer.write_node(file_node)
+            return path
+
+        def lookup(path):
+            if cache is None:
+                return None, None
+            # stat before scanning, a file modified during the scan is redone next time
+            key = stat_key(path)
+            return key, cache.get(path, key)
+
+        def merge(result):
+            nodes, search, referenced = result
+            uim_node_writer.write_raw(nodes)
+            search_writer.write_raw(search)
+            for p in referenced:
+                scan_queue.add_imported(p)
+
+        def finish(path, key, result):
+            *result, loaded, complete = result
+            # files that failed or timed out partway are scanned again next time
+            if cache is not None and complete:
+                cache.put(path, key, result, loaded)
+            merge(result)
+
+        if jobs == 1:
+            while scan_queue:
+                path = next_path()
+                key, result = lookup(path)
+                if result is not None:
+                    merge(result)
+                else:
+                    finish(path, key, scan_file(path, repo_root, verbose))
+            return
+
+        # Files are independent, the output streams are concatenations of
+        # length-delimited records so worker output is appended as is.
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            running = {}
+            while scan_queue or running:
+                while scan_queue and len(running) < 2 * jobs:
+                    path = next_path()
+                    key, result = lookup(path)
+                    if result is not None:
+                        merge(result)
+                    else:
+                        running[pool.submit(scan_file, path, repo_root, verbose)] = path, key
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    path, key = running.pop(f)
+                    finish(path, key, f.result())
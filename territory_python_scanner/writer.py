@@ -1,14 +1,162 @@
+import os
+from io import BytesIO
 from typing import Optional, Any
 
 from .uim_pb2 import Node, Token, Location, UniHref, IndexItem
 from .uim_pb2 import NodeKind, TokenType, IndexItemKind
 
 
+# Output streams are only flushed on close, records are buffered in between.
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Write output files through a raw descriptor with os.write, bypassing
+# BufferedWriter.  Set to False to use regular buffered files instead.
+USE_RAW_FD = os.name == 'posix'
+
+WIRETYPE_VARINT = 0
+WIRETYPE_LENGTH_DELIMITED = 2
+
+
+def _encode_varint(buf: bytearray, value: int) -> None:
+    """Append a variable-length integer to buf (protobuf format)."""
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            buf.append(byte | 0x80)
+        else:
+            buf.append(byte)
+            return
+
+
+# single byte encodings, most search index items and many nodes are this short
+_SMALL_VARINTS = [bytes((i,)) for i in range(0x80)]
+
+
+def _varint_bytes(value: int) -> bytes:
+    """Return the variable-length integer encoding of value (protobuf format)."""
+    if value < 0x80:
+        return _SMALL_VARINTS[value]
+    buf = bytearray()
+    _encode_varint(buf, value)
+    return bytes(buf)
+
+
+def _encode_tag(buf: bytearray, field: str, wire_type: int, message=Token) -> None:
+    """Append the key of a message field to buf."""
+    _encode_varint(buf, (message.DESCRIPTOR.fields_by_name[field].number << 3) | wire_type)
+
+
+def _encode_token(buf: bytearray, record: tuple) -> None:
+    """
+    Append the Token message of a UimTokenWriter record.  Fields go in field
+    number order, scalars are skipped when they hold the default value,
+    optional fields and the uni_href oneof are written when set.
+    """
+    token_type, offset, real_line, href, location, elided = record
+    if offset:
+        buf += _TOKEN_OFFSET_TAG
+        _encode_varint(buf, offset)
+    if token_type:
+        buf += _TOKEN_TYPE_TAG
+        _encode_varint(buf, token_type)
+    if real_line is not None:
+        buf += _TOKEN_REAL_LINE_TAG
+        _encode_varint(buf, real_line)
+
+    if href is not None:
+        path, href_offset = href
+        sub = bytearray()
+        if path:
+            path_bytes = path.encode('utf-8')
+            sub += _UNI_HREF_PATH_TAG
+            _encode_varint(sub, len(path_bytes))
+            sub += path_bytes
+        if href_offset:
+            sub += _UNI_HREF_OFFSET_TAG
+            _encode_varint(sub, href_offset)
+        buf += _TOKEN_UNI_HREF_TAG
+        _encode_varint(buf, len(sub))
+        buf += sub
+
+    if location is not None:
+        line, column, loc_offset = location
+        sub = bytearray()
+        if line:
+            sub += _LOCATION_LINE_TAG
+            _encode_varint(sub, line)
+        if column:
+            sub += _LOCATION_COLUMN_TAG
+            _encode_varint(sub, column)
+        if loc_offset:
+            sub += _LOCATION_OFFSET_TAG
+            _encode_varint(sub, loc_offset)
+        buf += _TOKEN_LOCATION_TAG
+        _encode_varint(buf, len(sub))
+        buf += sub
+
+    buf += _TOKEN_ELIDED_TAG
+    buf.append(1 if elided else 0)
+
+
+class _RawFile:
+    """Append-only output file written with os.write from a user-space buffer."""
+
+    def __init__(self, path: str):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.buf = bytearray()
+
+    def write(self, data) -> None:
+        self.buf += data
+        if len(self.buf) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        while self.buf:
+            n = os.write(self.fd, self.buf)
+            del self.buf[:n]
+
+    def close(self) -> None:
+        self.flush()
+        os.close(self.fd)
+
+
+def _open_output(path: str):
+    if USE_RAW_FD:
+        return _RawFile(path)
+    return open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+
+
+def _tag(field: str, wire_type: int, message=Token) -> bytes:
+    buf = bytearray()
+    _encode_tag(buf, field, wire_type, message)
+    return bytes(buf)
+
+
+# Tokens are encoded by hand, going through Token messages is the bottleneck
+# when emitting.  Keys are precomputed from the descriptors.
+_TOKEN_OFFSET_TAG = _tag('offset', WIRETYPE_VARINT)
+_TOKEN_TYPE_TAG = _tag('type', WIRETYPE_VARINT)
+_TOKEN_REAL_LINE_TAG = _tag('real_line', WIRETYPE_VARINT)
+_TOKEN_UNI_HREF_TAG = _tag('uni_href', WIRETYPE_LENGTH_DELIMITED)
+_TOKEN_LOCATION_TAG = _tag('uim_location', WIRETYPE_LENGTH_DELIMITED)
+_TOKEN_ELIDED_TAG = _tag('uim_elided', WIRETYPE_VARINT)
+_UNI_HREF_PATH_TAG = _tag('path', WIRETYPE_LENGTH_DELIMITED, UniHref)
+_UNI_HREF_OFFSET_TAG = _tag('offset', WIRETYPE_VARINT, UniHref)
+_LOCATION_LINE_TAG = _tag('line', WIRETYPE_VARINT, Location)
+_LOCATION_COLUMN_TAG = _tag('column', WIRETYPE_VARINT, Location)
+_LOCATION_OFFSET_TAG = _tag('offset', WIRETYPE_VARINT, Location)
+_NODE_TOKENS_TAG = _tag('tokens', WIRETYPE_LENGTH_DELIMITED, Node)
+
+_TOKEN_TYPES = dict(TokenType.items())
+
+
 class UimTokenWriter:
     def __init__(self, node: Node, calculated_line: int):
         self.node = node
         self.calculated_line = calculated_line
         self.text_parts = []
+        self.token_records = []
         self.offset = 0
 
     def append_token(
@@ -34,67 +182,46 @@ class UimTokenWriter:
         """
         # Convert string token type to enum value
         try:
-            pb_token_type = TokenType.Value(token_type)
-        except ValueError:
+            pb_token_type = _TOKEN_TYPES[token_type]
+        except KeyError:
             raise ValueError(f"invalid token type: {token_type}")
 
-        # Create a new token
-        tok = Token()
-        tok.type = pb_token_type
-
-        # Handle href if provided (uni_href is a oneof field in the Token message)
+        # Keep plain values, the Token is encoded when the node is written.
+        # real_line is only kept if it differs from calculated_line.
+        if real_line is not None and self.calculated_line == real_line:
+            real_line = None
         if href is not None:
-            uni_href = UniHref()
-            # Set path and offset from the href dictionary
-            uni_href.path = href.get("path", "")
-            uni_href.offset = href.get("offset", 0)
-
-            # Set the oneof field in the Token
-            tok.uni_href.CopyFrom(uni_href)
-
-        # Set real_line if it differs from calculated_line
-        if real_line is not None and self.calculated_line != real_line:
-            tok.real_line = real_line
+            href = (href.get("path", ""), href.get("offset", 0))
         if location is not None:
-            tok.uim_location.CopyFrom(location)
-        tok.uim_elided = elided
+            location = (location.line, location.column, location.offset)
+        self.token_records.append((pb_token_type, self.offset, real_line, href, location, elided))
 
         text_bytes = text.encode('utf-8')
-        tok.offset = self.offset
         self.offset += len(text_bytes)
         self.text_parts.append(text_bytes)
 
-        self.node.tokens.append(tok)
         self.calculated_line += text.count('\n')
 
 
 class UimNodeWriter:
-    def __init__(self, path: str):
+    def __init__(self, path: Optional[str] = None):
         """
         Create a new UimNodeWriter that writes to the specified file.
 
         Args:
-            path: The file path to write to
+            path: The file path to write to, or None to collect the output in memory
 
         Raises:
             IOError: If the file cannot be created
         """
+        if path is None:
+            self.file = BytesIO()
+            return
         try:
-            self.file = open(path, 'wb')
+            self.file = _open_output(path)
         except IOError as e:
             raise IOError(f"failed to create uim file: {e}")
 
-    def _write_varint(self, file, value):
-        """Write a variable-length integer to the file (protobuf format)."""
-        while True:
-            byte = value & 0x7f
-            value >>= 7
-            if value:
-                byte |= 0x80
-            file.write(bytes([byte]))
-            if not value:
-                break
-
     def begin_node(
         self,
         kind: str,
@@ -165,54 +292,69 @@ class UimNodeWriter:
             raise IOError("attempted to write node to a closed writer")
 
         try:
-            # Serialize the node using Protocol Buffers
+            # Serialize the node using Protocol Buffers, tokens are encoded
+            # by hand and appended as repeated field entries
             tw.node.text = b''.join(tw.text_parts)
-            serialized = tw.node.SerializeToString()
+            serialized = bytearray(tw.node.SerializeToString())
+            tok = bytearray()
+            for record in tw.token_records:
+                _encode_token(tok, record)
+                serialized += _NODE_TOKENS_TAG
+                _encode_varint(serialized, len(tok))
+                serialized += tok
+                tok.clear()
 
             # Write length-delimited format (size + data)
             # We need to implement this manually since Python protobuf doesn't have SerializeToDelimitedString
             size = len(serialized)
             # Variable-length encoding for the size prefix (similar to how protobuf does it)
-            self._write_varint(self.file, size)
+            self.file.write(_varint_bytes(size))
             self.file.write(serialized)
-            self.file.flush()
         except Exception as e:
             raise ValueError(f"failed to encode: {e}")
 
+    def write_raw(self, data: bytes) -> None:
+        """
+        Append already encoded length-delimited records, e.g. the output of an in-memory writer.
+
+        Raises:
+            IOError: If the writer is closed
+        """
+        if self.file is None:
+            raise IOError("attempted to write to a closed writer")
+        self.file.write(data)
+
+    def getvalue(self) -> bytes:
+        """Return everything written so far by an in-memory writer."""
+        return self.file.getvalue()
+
     def close(self) -> None:
         """Close the writer."""
         if self.file is not None:
+            self.file.flush()
             self.file.close()
             self.file = None
 
 
 class UimSearchIndexWriter:
-    def __init__(self, path: str):
+    def __init__(self, path: Optional[str] = None):
         """
         Create a new UimSearchIndexWriter that writes to the specified file.
 
         Args:
-            path: The file path to write to
+            path: The file path to write to, or None to collect the output in memory
 
         Raises:
             IOError: If the file cannot be created
         """
+        if path is None:
+            self.file = BytesIO()
+            return
         try:
-            self.file = open(path, 'wb')
+            self.file = _open_output(path)
         except IOError as e:
             raise IOError(f"failed to create uim search index file: {e}")
 
-    def _write_varint(self, file, value):
-        """Write a variable-length integer to the file (protobuf format)."""
-        while True:
-            byte = value & 0x7f
-            value >>= 7
-            if value:
-                byte |= 0x80
-            file.write(bytes([byte]))
-            if not value:
-                break
-
     def append(self, kind: str, key: str, href: Any, path: Optional[str] = None, typ: Optional[str] = None) -> None:
         """
         Append an index item to the file.
@@ -271,14 +413,29 @@ class UimSearchIndexWriter:
             serialized = item.SerializeToString()
             # Write length-delimited format
             size = len(serialized)
-            self._write_varint(self.file, size)
+            self.file.write(_varint_bytes(size))
             self.file.write(serialized)
-            self.file.flush()
         except Exception as e:
             raise ValueError(f"failed to encode: {e}")
 
+    def write_raw(self, data: bytes) -> None:
+        """
+        Append already encoded length-delimited records, e.g. the output of an in-memory writer.
+
+        Raises:
+            IOError: If the writer is closed
+        """
+        if self.file is None:
+            raise IOError("attempted to write to a closed writer")
+        self.file.write(data)
+
+    def getvalue(self) -> bytes:
+        """Return everything written so far by an in-memory writer."""
+        return self.file.getvalue()
+
     def close(self) -> None:
         """Close the writer."""
         if self.file is not None:
+            self.file.flush()
             self.file.close()
             self.file = None
@@ -1,5 +1,6 @@
 from pathlib import Path
 
+from territory_python_scanner import scanner
 from territory_python_scanner.scanner import scan_repo
 from territory_python_scanner.uim_pb2 import Node
 
@@ -146,6 +147,181 @@ def f(): …''',
     ]
 
 
+def test_hrefs(tmp_path):
+    code = r'''def foo():
+    return 'foo'
+
+foo()
+'''
+
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    (repo / 'example.py').write_text(code)
+    scan_repo(repo, tmp_path / 'nodes.uim', tmp_path / 'search.uim')
+
+    output = read_length_prefixed_pbs(tmp_path / 'nodes.uim')
+    file_node = output[-1]
+    path = str((repo / 'example.py').resolve())
+    refs = [
+        (tok_text(file_node, i), t.uni_href.path, t.uni_href.offset)
+        for i, t in enumerate(file_node.tokens)
+        if t.HasField('uni_href') and not t.uim_elided
+    ]
+    assert refs == [
+        ('foo', path, 4),
+    ]
+
+    def_node = output[0]
+    assert [
+        tok_text(def_node, i)
+        for i, t in enumerate(def_node.tokens)
+        if t.HasField('uni_href')
+    ] == ['foo']
+
+
+def test_shared_goto(tmp_path, monkeypatch):
+    # names resolved once per scope must get the same hrefs as when every
+    # occurrence is resolved on its own
+    code = r'''import os
+
+LIMIT = 10
+
+def make(markers, items):
+    def add(key):
+        if key in markers:
+            raise ValueError(key)
+        markers[key] = items
+        return markers, LIMIT, os
+    total = [i for i in items if i < LIMIT] + [i for i in range(LIMIT)]
+    return add(total), dict(markers=markers), len(total)
+
+class A:
+    LIMIT = 1
+    def f(self, x):
+        x = LIMIT
+        return x, make(self, x)
+'''
+
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    (repo / 'example.py').write_text(code)
+    scan_repo(repo, tmp_path / 'shared.uim', tmp_path / 'search.uim', jobs=1)
+
+    shared_goto_key = scanner.shared_goto_key
+    shared = []
+    def recording_shared_goto_key(g, tree):
+        key = shared_goto_key(g, tree)
+        if key is not None:
+            shared.append(tree.value)
+        return None
+    monkeypatch.setattr(scanner, 'shared_goto_key', recording_shared_goto_key)
+    scan_repo(repo, tmp_path / 'single.uim', tmp_path / 'search.uim', jobs=1)
+
+    assert 'LIMIT' in shared and 'os' in shared
+    assert 'markers' not in shared
+    assert read_length_prefixed_pbs(tmp_path / 'shared.uim') == read_length_prefixed_pbs(tmp_path / 'single.uim')
+
+
+def test_parallel_scan(tmp_path):
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    for name in ['a', 'b', 'c']:
+        (repo / f'{name}.py').write_text(f'def {name}():\n    pass\n')
+
+    scan_repo(repo, tmp_path / 'seq.uim', tmp_path / 'seq_search.uim', jobs=1)
+    scan_repo(repo, tmp_path / 'par.uim', tmp_path / 'par_search.uim', jobs=2)
+
+    seq = read_length_prefixed_pbs(tmp_path / 'seq.uim')
+    par = read_length_prefixed_pbs(tmp_path / 'par.uim')
+    assert len(par) == 6
+    assert sorted(n.SerializeToString() for n in par) == sorted(n.SerializeToString() for n in seq)
+
+
+def test_scan_cache(tmp_path, monkeypatch):
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    (repo / 'a.py').write_text('def a():\n    pass\n')
+    (repo / 'b.py').write_text('from a import a\n\na()\n')
+    cache = tmp_path / 'scan.cache'
+
+    scan_repo(repo, tmp_path / 'first.uim', tmp_path / 'search.uim', jobs=1, cache_path=cache)
+
+    scanned = []
+    scan_file = scanner.scan_file
+    def counting_scan_file(path, *args):
+        scanned.append(Path(path).name)
+        return scan_file(path, *args)
+    monkeypatch.setattr(scanner, 'scan_file', counting_scan_file)
+
+    scan_repo(repo, tmp_path / 'second.uim', tmp_path / 'search.uim', jobs=1, cache_path=cache)
+    assert scanned == []
+    assert (tmp_path / 'second.uim').read_bytes() != b''
+    assert sorted(n.SerializeToString() for n in read_length_prefixed_pbs(tmp_path / 'second.uim')) == \
+        sorted(n.SerializeToString() for n in read_length_prefixed_pbs(tmp_path / 'first.uim'))
+
+    # b references a, so changing a invalidates both
+    (repo / 'a.py').write_text('def a(x=1):\n    pass\n')
+    scan_repo(repo, tmp_path / 'third.uim', tmp_path / 'search.uim', jobs=1, cache_path=cache)
+    assert sorted(scanned) == ['a.py', 'b.py']
+
+    # d re-exports x from e through f, d's references land in g but also
+    # depend on f
+    (repo / 'd.py').write_text('from e import x\nprint(x)\n')
+    (repo / 'e.py').write_text('from f import x\n')
+    (repo / 'f.py').write_text('from g import x\n')
+    (repo / 'g.py').write_text('x = 1\n')
+    (repo / 'h.py').write_text('x = 2\n')
+    scan_repo(repo, tmp_path / 'fourth.uim', tmp_path / 'search.uim', jobs=1, cache_path=cache)
+    scanned.clear()
+    (repo / 'f.py').write_text('from h import x\n')
+    scan_repo(repo, tmp_path / 'fifth.uim', tmp_path / 'search.uim', jobs=1, cache_path=cache)
+    assert sorted(scanned) == ['d.py', 'e.py', 'f.py']
+    d_node = [n for n in read_length_prefixed_pbs(tmp_path / 'fifth.uim') if n.path.endswith('d.py')][-1]
+    x_hrefs = [t.uni_href.path for i, t in enumerate(d_node.tokens) if tok_text(d_node, i) == 'x']
+    assert [Path(p).name for p in x_hrefs] == ['h.py', 'h.py']
+
+    # a new file can shadow an import target, everything is scanned again
+    scanned.clear()
+    (repo / 'i.py').write_text('')
+    scan_repo(repo, tmp_path / 'sixth.uim', tmp_path / 'search.uim', jobs=1, cache_path=cache)
+    assert sorted(scanned) == ['a.py', 'b.py', 'd.py', 'e.py', 'f.py', 'g.py', 'h.py', 'i.py']
+
+
+def test_line_breaks(tmp_path):
+    assert list(scanner.scan_line_offsets('a\nb\r\nc\rd\x0ce\r')) == [0, 2, 5, 7, 11, 11]
+
+    for eol in ['\r', '\r\n']:
+        repo = tmp_path / f'repo{len(eol)}'
+        repo.mkdir()
+        code = eol.join(['def foo():', '    return 1', '', 'foo()', ''])
+        (repo / 'a.py').write_bytes(code.encode())
+        nodes = tmp_path / f'nodes{len(eol)}.uim'
+        scan_repo(repo, nodes, tmp_path / 'search.uim', jobs=1)
+
+        file_node = read_length_prefixed_pbs(nodes)[-1]
+        assert file_node.text.endswith('foo()' + eol)
+        call = [t for i, t in enumerate(file_node.tokens) if tok_text(file_node, i) == 'foo'][-1]
+        assert call.uim_location.line == 4
+        assert call.uim_location.offset == code.rindex('foo()')
+
+
+def test_walk_skips_unreadable_dirs(tmp_path, monkeypatch):
+    (tmp_path / 'ok').mkdir()
+    (tmp_path / 'ok' / 'a.py').write_text('')
+    (tmp_path / 'locked').mkdir()
+    (tmp_path / 'locked' / 'b.py').write_text('')
+
+    scandir = scanner.os.scandir
+    def failing_scandir(path):
+        if Path(path).name == 'locked':
+            raise PermissionError(path)
+        return scandir(path)
+    monkeypatch.setattr(scanner.os, 'scandir', failing_scandir)
+
+    assert list(scanner.walk_py(tmp_path)) == [str(tmp_path / 'ok' / 'a.py')]
+    assert scanner.gather_py_paths(tmp_path) == [str(tmp_path / 'ok' / 'a.py')]
+    assert scanner.gather_py_paths(tmp_path / 'locked') == []
+
 
 def read_varint(file):
     value = 0
@@ -186,3 +362,9 @@ def dump_tagged(n):
     o.append(f'{n.start.line}:{n.start.column} ({n.start.offset}) d{n.uim_nest_level}\n')
     o.append(n.text)
     return ''.join(o)
+
+
+def tok_text(n, i):
+    text = n.text.encode('utf-8')
+    end = n.tokens[i+1].offset if i+1 < len(n.tokens) else len(text)
+    return text[n.tokens[i].offset:end].decode('utf-8')